@@ -1,20 +1,22 @@
+from __future__ import annotations
+
 import base64
+import csv
 import json
-import math
-from dataclasses import dataclass, asdict
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
+from typing import TYPE_CHECKING
 
 import numpy as np
-import pandas as pd
 import streamlit as st
 
-# NEW libs
-import qrcode
-from PIL import Image
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+# pandas, qrcode and reportlab are imported lazily: a fresh session with no cases
+# never touches them.
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 # =========================
@@ -23,10 +25,7 @@ from reportlab.pdfgen import canvas
 APP_VERSION = "v9.0 – High‑Trust + ESI + EWS Alert + Trend + Explainability + PDF+QR + CodeBlue"
 MODEL_NOTE = "Safety-first: Red flags > Clinical protocol (EWS/ESI) > AI Risk+Uncertainty (HITL). Explainability = contribution-based (not clinical SHAP)."
 
-st.set_page_config(page_title="Smart Triage AI Pro", layout="wide", page_icon="🚑")
-
-st.markdown(
-    """
+APP_CSS = """
 <style>
 .main { background-color: #0b1220; }
 .block-container { padding-top: 1.2rem; }
@@ -52,8 +51,8 @@ st.markdown(
     border-radius: 12px;
 }
 
-/* Big Code Blue button */
-div.stButton > button.codeblue {
+/* Big Code Blue button (st.button key="codeblue" → container class st-key-codeblue) */
+.st-key-codeblue button {
     background: #ef4444 !important;
     color: white !important;
     font-weight: 800 !important;
@@ -63,15 +62,18 @@ div.stButton > button.codeblue {
     width: 100% !important;
 }
 </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
+
+st.set_page_config(page_title="Smart Triage AI Pro", layout="wide", page_icon="🚑")
+
+# Re-sent every rerun on purpose: Streamlit drops elements a rerun does not emit.
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 
 # =========================
 # DATA MODEL
 # =========================
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Patient:
     age: int
     hr: int
@@ -108,27 +110,36 @@ def calculate_shock_index(hr: int, sbp: int) -> float:
     return round(hr / sbp, 2) if sbp > 0 else 0.0
 
 
-def calculate_ews(hr: int, rr: int, sbp: int, temp: float, spo2: int) -> int:
-    score = 0
-    if hr > 110 or hr < 50: score += 2
-    if rr > 24 or rr < 10: score += 2
-    if sbp < 90 or sbp > 180: score += 2
-    if temp > 38.5 or temp < 35.5: score += 1
-    if spo2 < 94: score += 3
-    return score
+def calculate_ews(
+    hr: int | pd.Series, rr: int | pd.Series, sbp: int | pd.Series, temp: float | pd.Series, spo2: int | pd.Series
+) -> int | pd.Series:
+    """Branchless (| instead of or), so it also scores whole logs columns at once."""
+    return (
+        2 * ((hr > 110) | (hr < 50))
+        + 2 * ((rr > 24) | (rr < 10))
+        + 2 * ((sbp < 90) | (sbp > 180))
+        + 1 * ((temp > 38.5) | (temp < 35.5))
+        + 3 * (spo2 < 94)
+    )
 
 
 # =========================
 # VALIDATION
 # =========================
+# (field, lo, hi, message) hard limits, checked in order.
+VALIDATION_RANGES = (
+    ("age", 0, 120, "Tuổi ngoài phạm vi 0–120."),
+    ("hr", 20, 250, "HR ngoài phạm vi 20–250."),
+    ("sbp", 40, 250, "SBP ngoài phạm vi 40–250."),
+    ("spo2", 50, 100, "SpO₂ ngoài phạm vi 50–100%."),
+    ("rr", 5, 60, "RR ngoài phạm vi 5–60."),
+    ("temp", 34.0, 42.0, "Nhiệt độ ngoài phạm vi 34–42°C."),
+)
+
+
 def validate_inputs(p: Patient):
-    hard, soft = [], []
-    if not (0 <= p.age <= 120): hard.append("Tuổi ngoài phạm vi 0–120.")
-    if not (20 <= p.hr <= 250): hard.append("HR ngoài phạm vi 20–250.")
-    if not (40 <= p.sbp <= 250): hard.append("SBP ngoài phạm vi 40–250.")
-    if not (50 <= p.spo2 <= 100): hard.append("SpO₂ ngoài phạm vi 50–100%.")
-    if not (5 <= p.rr <= 60): hard.append("RR ngoài phạm vi 5–60.")
-    if not (34.0 <= p.temp <= 42.0): hard.append("Nhiệt độ ngoài phạm vi 34–42°C.")
+    hard = [msg for field, lo, hi, msg in VALIDATION_RANGES if not (lo <= getattr(p, field) <= hi)]
+    soft = []
     g = gcs_total(p)
     if not (3 <= g <= 15): hard.append("GCS không hợp lệ.")
     if p.spo2 < 88 and not p.dyspnea:
@@ -141,37 +152,56 @@ def validate_inputs(p: Patient):
 # =========================
 # HARD SAFETY (RED FLAGS)
 # =========================
+# Each rule reads values by log column name and combines them with & / |, so the
+# same predicate checks one case (scalars) or a whole logs frame (columns).
+RED_FLAG_RULES = (
+    ("Nghi sốc phản vệ", lambda v: v["Phản vệ"]),
+    ("Hôn mê nặng (GCS ≤ 8)", lambda v: v["GCS"] <= 8),
+    ("FAST dương tính (nghi đột quỵ)", lambda v: v["FAST"]),
+    ("Suy hô hấp nặng (SpO₂ < 90%)", lambda v: v["SpO2"] < 90),
+    ("Sốc / tụt huyết áp (SBP < 90)", lambda v: v["SBP"] < 90),
+    ("Shock Index nguy hiểm ({si})", lambda v: v["ShockIndex"] > 1.0),
+    ("Thở nhanh nặng (RR ≥ 30)", lambda v: v["RR"] >= 30),
+    ("Mạch nhanh nặng (HR ≥ 140)", lambda v: v["HR"] >= 140),
+    ("Chảy máu + huyết động xấu", lambda v: v["Chảy máu"] & ((v["SBP"] < 100) | (v["HR"] > 110))),
+    ("Nghi ngộ độc + giảm tri giác", lambda v: v["Ngộ độc"] & (v["GCS"] <= 12)),
+    ("EWS rất cao (≥ 7)", lambda v: v["EWS"] >= 7),
+)
+
+
 def red_flags(p: Patient, si: float, ews: int):
-    g = gcs_total(p)
-    flags = []
-    if p.anaphylaxis: flags.append("Nghi sốc phản vệ")
-    if g <= 8: flags.append("Hôn mê nặng (GCS ≤ 8)")
-    if p.fast_stroke: flags.append("FAST dương tính (nghi đột quỵ)")
-    if p.spo2 < 90: flags.append("Suy hô hấp nặng (SpO₂ < 90%)")
-    if p.sbp < 90: flags.append("Sốc / tụt huyết áp (SBP < 90)")
-    if si > 1.0: flags.append(f"Shock Index nguy hiểm ({si})")
-    if p.rr >= 30: flags.append("Thở nhanh nặng (RR ≥ 30)")
-    if p.hr >= 140: flags.append("Mạch nhanh nặng (HR ≥ 140)")
-    if p.bleeding and (p.sbp < 100 or p.hr > 110): flags.append("Chảy máu + huyết động xấu")
-    if p.poisoning_overdose and g <= 12: flags.append("Nghi ngộ độc + giảm tri giác")
-    if ews >= 7: flags.append("EWS rất cao (≥ 7)")
-    return flags
+    v = {
+        "Phản vệ": p.anaphylaxis, "GCS": gcs_total(p), "FAST": p.fast_stroke,
+        "SpO2": p.spo2, "SBP": p.sbp, "ShockIndex": si, "RR": p.rr, "HR": p.hr,
+        "Chảy máu": p.bleeding, "Ngộ độc": p.poisoning_overdose, "EWS": ews,
+    }
+    return [label.format(si=si) for label, rule in RED_FLAG_RULES if rule(v)]
+
+
+def red_flags_batch(df: pd.DataFrame) -> list[list[str]]:
+    """Red flags for every row of a logs frame, one vectorized pass per rule."""
+    hits = np.column_stack([np.asarray(rule(df), dtype=bool) for _, rule in RED_FLAG_RULES])
+    si = df["ShockIndex"].to_numpy()
+    return [
+        [RED_FLAG_RULES[j][0].format(si=si[i]) for j in np.flatnonzero(row)]
+        for i, row in enumerate(hits)
+    ]
 
 
 # =========================
 # ESI (ESI-lite)
 # =========================
 def estimate_resources(p: Patient) -> int:
-    r = 0
-    if p.chest_pain: r += 2
-    if p.dyspnea or p.spo2 < 94: r += 2
-    if p.trauma: r += 2
-    if p.bleeding: r += 2
-    if p.abdominal_pain: r += 1
-    if p.infection_suspected: r += 1
-    if p.poisoning_overdose: r += 2
-    if p.pregnancy: r += 1
-    return r
+    return (
+        2 * p.chest_pain
+        + 2 * (p.dyspnea | (p.spo2 < 94))
+        + 2 * p.trauma
+        + 2 * p.bleeding
+        + 1 * p.abdominal_pain
+        + 1 * p.infection_suspected
+        + 2 * p.poisoning_overdose
+        + 1 * p.pregnancy
+    )
 
 
 def esi_level(p: Patient, flags: list, ews: int):
@@ -188,9 +218,11 @@ def esi_level(p: Patient, flags: list, ews: int):
 # =========================
 # AI RISK + UNCERTAINTY (NO TRAIN)
 # =========================
-def sigmoid(x: float) -> float:
-    x = max(min(x, 40), -40)
-    return 1.0 / (1.0 + math.exp(-x))
+def sigmoid(x):
+    """Logistic function: float for a scalar, ndarray for an array. exp(-|x|) never overflows, so no clipping is needed."""
+    e = np.exp(-np.abs(x))
+    s = np.where(x >= 0, 1.0, e) / (1.0 + e)
+    return float(s) if np.ndim(x) == 0 else s
 
 
 FEATURE_LABELS = {
@@ -217,73 +249,143 @@ FEATURE_LABELS = {
 }
 
 
-def features(p: Patient):
+# Fixed feature layout shared by features(), the ensemble weights and explanations.
+FEATURE_ORDER = (
+    "age", "hr_excess", "sbp_drop", "spo2_drop", "rr_excess", "temp_excess", "gcs_drop",
+    "chest_pain", "dyspnea", "trauma", "pain_hi", "onset_sudden", "worsening",
+    "fast_stroke", "bleeding", "abdominal_pain", "pregnancy", "infection",
+    "anaphylaxis", "poisoning",
+)
+
+
+def features(p: Patient) -> np.ndarray:
+    """Feature vector of `p`, laid out as FEATURE_ORDER."""
     g = gcs_total(p)
-    return {
-        "age": float(p.age),
-        "hr_excess": float(max(0, p.hr - 90)),
-        "sbp_drop": float(max(0, 100 - p.sbp)),
-        "spo2_drop": float(max(0, 95 - p.spo2)),
-        "rr_excess": float(max(0, p.rr - 18)),
-        "temp_excess": float(max(0, p.temp - 37.5)),
-        "gcs_drop": float(max(0, 15 - g)),
-        "chest_pain": float(int(p.chest_pain)),
-        "dyspnea": float(int(p.dyspnea)),
-        "trauma": float(int(p.trauma)),
-        "pain_hi": float(int(p.pain_level >= 7)),
-        "onset_sudden": float(int(p.onset == "Đột ngột")),
-        "worsening": float(int(p.progression == "Nặng dần")),
-        "fast_stroke": float(int(p.fast_stroke)),
-        "bleeding": float(int(p.bleeding)),
-        "abdominal_pain": float(int(p.abdominal_pain)),
-        "pregnancy": float(int(p.pregnancy)),
-        "infection": float(int(p.infection_suspected)),
-        "anaphylaxis": float(int(p.anaphylaxis)),
-        "poisoning": float(int(p.poisoning_overdose)),
-    }
+    return np.array([
+        p.age,
+        max(0, p.hr - 90),
+        max(0, 100 - p.sbp),
+        max(0, 95 - p.spo2),
+        max(0, p.rr - 18),
+        max(0, p.temp - 37.5),
+        max(0, 15 - g),
+        p.chest_pain,
+        p.dyspnea,
+        p.trauma,
+        p.pain_level >= 7,
+        p.onset == "Đột ngột",
+        p.progression == "Nặng dần",
+        p.fast_stroke,
+        p.bleeding,
+        p.abdominal_pain,
+        p.pregnancy,
+        p.infection_suspected,
+        p.anaphylaxis,
+        p.poisoning_overdose,
+    ], dtype=np.float64)
+
+
+# Display labels aligned to FEATURE_ORDER, so explanations index by position.
+FEATURE_LABELS_IN_ORDER = np.array([FEATURE_LABELS.get(k, k) for k in FEATURE_ORDER], dtype=object)
+FEATURE_ORDER_ARR = np.array(FEATURE_ORDER, dtype=object)
+
+
+BASE_WEIGHTS = {
+    "b0": -7.2,
+    "age": 0.010,
+    "hr_excess": 0.020,
+    "sbp_drop": 0.050,
+    "spo2_drop": 0.120,
+    "rr_excess": 0.030,
+    "temp_excess": 0.40,
+    "gcs_drop": 0.55,
+    "chest_pain": 0.25,
+    "dyspnea": 0.55,
+    "trauma": 0.35,
+    "pain_hi": 0.15,
+    "onset_sudden": 0.12,
+    "worsening": 0.18,
+    "fast_stroke": 0.80,
+    "bleeding": 0.60,
+    "abdominal_pain": 0.25,
+    "pregnancy": 0.30,
+    "infection": 0.45,
+    "anaphylaxis": 1.20,
+    "poisoning": 0.55,
+}
+BASE_COEF = np.array([BASE_WEIGHTS[k] for k in FEATURE_ORDER], dtype=np.float64)
 
 
-def ensemble_predict_with_explain(p: Patient):
-    base = {
-        "b0": -7.2,
-        "age": 0.010,
-        "hr_excess": 0.020,
-        "sbp_drop": 0.050,
-        "spo2_drop": 0.120,
-        "rr_excess": 0.030,
-        "temp_excess": 0.40,
-        "gcs_drop": 0.55,
-        "chest_pain": 0.25,
-        "dyspnea": 0.55,
-        "trauma": 0.35,
-        "pain_hi": 0.15,
-        "onset_sudden": 0.12,
-        "worsening": 0.18,
-        "fast_stroke": 0.80,
-        "bleeding": 0.60,
-        "abdominal_pain": 0.25,
-        "pregnancy": 0.30,
-        "infection": 0.45,
-        "anaphylaxis": 1.20,
-        "poisoning": 0.55,
-    }
+@dataclass(frozen=True, slots=True)
+class Ensemble:
+    W: np.ndarray   # (n_models, n_features) perturbed coefficients
+    b0: np.ndarray  # (n_models,) perturbed intercepts
+    feature_order: tuple = FEATURE_ORDER
+
+
+@st.cache_resource(show_spinner=False)
+def build_ensemble(n_models: int = 25, seed: int = 42) -> Ensemble:
+    """
+    Demo ensemble as contiguous arrays. Fixed seed → identical every rerun, so build
+    once per process. Noise column 0 is the intercept, the rest per coefficient
+    (same draw order as the old per-model loop).
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((n_models, 1 + len(BASE_COEF)))
+    b0 = BASE_WEIGHTS["b0"] + 0.30 * noise[:, 0]
+    W = BASE_COEF * (1.0 + 0.10 * noise[:, 1:])
+    # float32 is plenty for a score shown to 0.1% and halves the matrix footprint.
+    W, b0 = W.astype(np.float32), b0.astype(np.float32)
+    W.flags.writeable = b0.flags.writeable = False  # shared across sessions
+    return Ensemble(W=W, b0=b0)
 
+
+ENSEMBLE = build_ensemble()
+
+
+def ensemble_predict_with_explain(p: Patient):
     x = features(p)
-    rng = np.random.default_rng(42)
-    preds = []
-    for _ in range(25):
-        z = base["b0"] + rng.normal(0, 0.30)
-        for k, v in x.items():
-            z += base[k] * (1 + rng.normal(0, 0.10)) * v
-        preds.append(sigmoid(z))
-
-    arr = np.array(preds, dtype=float)
+    arr = sigmoid(ENSEMBLE.W @ x.astype(np.float32) + ENSEMBLE.b0)
     mean_r = float(arr.mean())
     std_u = float(arr.std(ddof=1))
 
-    contrib = {k: float(base[k] * v) for k, v in x.items()}
-    contrib_sorted = dict(sorted(contrib.items(), key=lambda kv: abs(kv[1]), reverse=True))
-    return mean_r, std_u, contrib_sorted, preds
+    contrib = BASE_COEF * x  # per-feature contribution, aligned to FEATURE_ORDER
+    return mean_r, std_u, contrib
+
+
+def features_batch(df: pd.DataFrame) -> np.ndarray:
+    """(M, F) feature matrix from a logs frame, same layout as features()."""
+    def col(c):
+        return df[c].to_numpy(dtype=np.float64)
+
+    return np.column_stack([
+        col("Tuổi"),
+        np.maximum(0, col("HR") - 90),
+        np.maximum(0, 100 - col("SBP")),
+        np.maximum(0, 95 - col("SpO2")),
+        np.maximum(0, col("RR") - 18),
+        np.maximum(0, col("Temp") - 37.5),
+        np.maximum(0, 15 - col("GCS")),
+        col("Đau ngực"),
+        col("Khó thở"),
+        col("Chấn thương"),
+        col("VAS") >= 7,
+        df["Khởi phát"].to_numpy() == "Đột ngột",
+        df["Diễn tiến"].to_numpy() == "Nặng dần",
+        col("FAST"),
+        col("Chảy máu"),
+        col("Đau bụng"),
+        col("Thai kỳ"),
+        col("Nghi nhiễm"),
+        col("Phản vệ"),
+        col("Ngộ độc"),
+    ])
+
+
+def ensemble_predict_batch(X: np.ndarray):
+    """Risk and uncertainty for every row of X in one (M, F) @ (F, N) product."""
+    P = sigmoid(X.astype(np.float32) @ ENSEMBLE.W.T + ENSEMBLE.b0)
+    return P.mean(axis=1), P.std(axis=1, ddof=1)
 
 
 def uncertainty_level(u: float) -> str:
@@ -301,20 +403,24 @@ def triage_from_risk(r: float) -> str:
 # =========================
 # EXPLAINABILITY (Feature Importance %)
 # =========================
-def feature_importance_percent(contrib_sorted: dict, top_n: int = 8) -> pd.DataFrame:
+@st.cache_data(show_spinner=False, max_entries=64)
+def feature_importance_percent(contrib: np.ndarray, top_n: int = 8) -> pd.DataFrame:
     """
     Convert contribution magnitudes into % so BGK can see:
     'RR contributes 40%...'
     Note: this is a transparent contribution-based explanation (not SHAP).
     """
-    items = list(contrib_sorted.items())
-    mags = np.array([abs(v) for _, v in items], dtype=float)
+    import pandas as pd
+
+    mags = np.abs(contrib)
     total = float(mags.sum()) if mags.sum() > 0 else 1.0
-    rows = []
-    for k, v in items[:top_n]:
-        pct = abs(v) / total * 100.0
-        rows.append({"Feature": k, "Yếu tố": FEATURE_LABELS.get(k, k), "Đóng góp (%)": pct, "Hướng": "Tăng nguy cơ" if v > 0 else "Giảm nguy cơ"})
-    return pd.DataFrame(rows)
+    idx = np.argsort(-mags, kind="stable")[:top_n]
+    return pd.DataFrame({
+        "Feature": FEATURE_ORDER_ARR[idx],
+        "Yếu tố": FEATURE_LABELS_IN_ORDER[idx],
+        "Đóng góp (%)": mags[idx] / total * 100.0,
+        "Hướng": np.where(contrib[idx] > 0, "Tăng nguy cơ", "Giảm nguy cơ"),
+    })
 
 
 # =========================
@@ -344,6 +450,29 @@ def send_alert(message: str) -> bool:
 # =========================
 # TRIAGE DECISION
 # =========================
+# Every triage label starts with its colour emoji; routing checks that prefix.
+# (risk band, uncertainty CAO?) → decision, for cases no safety rule has claimed.
+RISK_DECISIONS = {
+    ("🔴 ĐỎ", True): ("🟡 VÀNG (REVIEW)", "#FFA500", "Risk cao nhưng Uncertainty CAO → cần bác sĩ review."),
+    ("🔴 ĐỎ", False): ("🔴 ĐỎ (CẢNH BÁO)", "#FF4B4B", "Risk cao & Uncertainty thấp → cảnh báo mạnh."),
+    ("🟡 VÀNG", True): ("🟡 VÀNG (REVIEW)", "#FFA500", "Vùng xám + Uncertainty CAO → đo lại vitals/bổ sung ngữ cảnh."),
+    ("🟡 VÀNG", False): ("🟡 VÀNG (ƯU TIÊN)", "#FFA500", "Risk trung bình → theo dõi sát/khám ưu tiên."),
+    ("🟢 XANH", True): ("🟢 XANH (ỔN ĐỊNH)", "#28A745", "Risk thấp → ít nguy kịch (bác sĩ quyết định cuối)."),
+    ("🟢 XANH", False): ("🟢 XANH (ỔN ĐỊNH)", "#28A745", "Risk thấp → ít nguy kịch (bác sĩ quyết định cuối)."),
+}
+
+
+# Symptoms that make a case VÀNG (ƯU TIÊN) whatever the AI risk says.
+PRIORITY_SYMPTOMS = (
+    lambda p: p.chest_pain,
+    lambda p: p.pain_level >= 7,
+    lambda p: p.fast_stroke,
+    lambda p: p.anaphylaxis,
+    lambda p: p.bleeding,
+    lambda p: p.poisoning_overdose,
+)
+
+
 def triage_decision(flags: list, ews: int, risk: float, u: float, p: Patient):
     if flags:
         return "🔴 ĐỎ (CẤP CỨU)", "#FF4B4B", "Luật an toàn kích hoạt: " + ", ".join(flags)
@@ -351,103 +480,137 @@ def triage_decision(flags: list, ews: int, risk: float, u: float, p: Patient):
     if ews >= 5:
         return "🔴 ĐỎ (CẤP CỨU)", "#FF4B4B", f"EWS cao (≥5): {ews}. Ưu tiên đánh giá ngay."
 
-    if (
-        ews >= 3
-        or p.chest_pain
-        or p.pain_level >= 7
-        or p.fast_stroke
-        or p.anaphylaxis
-        or p.bleeding
-        or p.poisoning_overdose
-    ):
+    if ews >= 3 or any(rule(p) for rule in PRIORITY_SYMPTOMS):
         note = f"Ưu tiên theo triệu chứng/điểm: EWS={ews}."
         if uncertainty_level(u) == "CAO":
             note += " Uncertainty CAO → cần bác sĩ xác nhận/đo lại."
         return "🟡 VÀNG (ƯU TIÊN)", "#FFA500", note
 
-    base = triage_from_risk(risk)
-    if base.startswith("🔴"):
-        if uncertainty_level(u) == "CAO":
-            return "🟡 VÀNG (REVIEW)", "#FFA500", "Risk cao nhưng Uncertainty CAO → cần bác sĩ review."
-        return "🔴 ĐỎ (CẢNH BÁO)", "#FF4B4B", "Risk cao & Uncertainty thấp → cảnh báo mạnh."
-
-    if base.startswith("🟡"):
-        if uncertainty_level(u) == "CAO":
-            return "🟡 VÀNG (REVIEW)", "#FFA500", "Vùng xám + Uncertainty CAO → đo lại vitals/bổ sung ngữ cảnh."
-        return "🟡 VÀNG (ƯU TIÊN)", "#FFA500", "Risk trung bình → theo dõi sát/khám ưu tiên."
-
-    return "🟢 XANH (ỔN ĐỊNH)", "#28A745", "Risk thấp → ít nguy kịch (bác sĩ quyết định cuối)."
+    return RISK_DECISIONS[(triage_from_risk(risk), uncertainty_level(u) == "CAO")]
 
 
 # =========================
 # DEPARTMENT + PROTOCOL (rút gọn)
 # =========================
+# Ordered (predicate(p, gcs), department, reason) rules; the first match wins.
+CRITICAL_DEPT_RULES = (
+    (lambda p, g: p.age < 16, "Cấp cứu/Hồi sức → Nhi", "Nguy kịch + tuổi nhi."),
+    (lambda p, g: p.anaphylaxis, "Cấp cứu/Hồi sức", "Phản vệ: ưu tiên ABC."),
+    (lambda p, g: p.fast_stroke or g <= 12, "Cấp cứu/Hồi sức → Thần kinh", "Giảm tri giác/FAST (+)."),
+    (lambda p, g: p.bleeding, "Cấp cứu/Hồi sức → Ngoại/Tiêu hoá", "Chảy máu: hồi sức."),
+    (lambda p, g: p.chest_pain, "Cấp cứu/Hồi sức → Tim mạch", "Đau ngực nguy kịch."),
+    (lambda p, g: p.dyspnea or p.spo2 < 94, "Cấp cứu/Hồi sức → Hô hấp", "Khó thở/SpO₂ giảm."),
+)
+CRITICAL_DEPT_DEFAULT = ("Cấp cứu/Hồi sức", "Ổn định ABC trước.")
+
+DEPT_RULES = (
+    (lambda p, g: p.age < 16, "Nhi", "Tuổi < 16."),
+    (lambda p, g: p.pregnancy, "Sản", "Thai kỳ."),
+    (lambda p, g: p.fast_stroke or g <= 13, "Thần kinh", "Nghi đột quỵ/tri giác giảm."),
+    (lambda p, g: p.trauma, "Ngoại/Chấn thương", "Chấn thương."),
+    (lambda p, g: p.chest_pain, "Tim mạch", "Đau ngực."),
+    (lambda p, g: p.dyspnea or p.spo2 < 94, "Hô hấp", "Khó thở/SpO₂ giảm."),
+    (lambda p, g: p.infection_suspected, "Nội/Nhiễm", "Nghi nhiễm trùng."),
+)
+DEPT_DEFAULT = ("Cấp cứu/Nội tổng quát", "Không có cụm nổi bật.")
+
+
 def recommend_department(p: Patient, triage: str, flags: list):
-    is_peds = p.age < 16
     g = gcs_total(p)
+    if flags or triage.startswith("🔴"):
+        rules, default = CRITICAL_DEPT_RULES, CRITICAL_DEPT_DEFAULT
+    else:
+        rules, default = DEPT_RULES, DEPT_DEFAULT
+    return next(((dept, reason) for rule, dept, reason in rules if rule(p, g)), default)
+
 
-    if flags or ("🔴" in triage):
-        if is_peds: return "Cấp cứu/Hồi sức → Nhi", "Nguy kịch + tuổi nhi."
-        if p.anaphylaxis: return "Cấp cứu/Hồi sức", "Phản vệ: ưu tiên ABC."
-        if p.fast_stroke or g <= 12: return "Cấp cứu/Hồi sức → Thần kinh", "Giảm tri giác/FAST (+)."
-        if p.bleeding: return "Cấp cứu/Hồi sức → Ngoại/Tiêu hoá", "Chảy máu: hồi sức."
-        if p.chest_pain: return "Cấp cứu/Hồi sức → Tim mạch", "Đau ngực nguy kịch."
-        if p.dyspnea or p.spo2 < 94: return "Cấp cứu/Hồi sức → Hô hấp", "Khó thở/SpO₂ giảm."
-        return "Cấp cứu/Hồi sức", "Ổn định ABC trước."
-
-    if is_peds: return "Nhi", "Tuổi < 16."
-    if p.pregnancy: return "Sản", "Thai kỳ."
-    if p.fast_stroke or g <= 13: return "Thần kinh", "Nghi đột quỵ/tri giác giảm."
-    if p.trauma: return "Ngoại/Chấn thương", "Chấn thương."
-    if p.chest_pain: return "Tim mạch", "Đau ngực."
-    if p.dyspnea or p.spo2 < 94: return "Hô hấp", "Khó thở/SpO₂ giảm."
-    if p.infection_suspected: return "Nội/Nhiễm", "Nghi nhiễm trùng."
-    return "Cấp cứu/Nội tổng quát", "Không có cụm nổi bật."
+# (substring of the department, extra actions), applied in order.
+DEPT_ACTIONS = (
+    ("Tim mạch", ("ECG sớm", "Men tim theo protocol")),
+    ("Thần kinh", ("Đường huyết", "CT theo quy trình đột quỵ")),
+    ("Hô hấp", ("Oxy", "X-quang phổi/khí máu nếu cần")),
+    ("Ngoại", ("ABCDE", "Kiểm soát chảy máu/bất động")),
+    ("Sản", ("Đánh giá mẹ và thai",)),
+)
 
 
 def protocol_actions(dept: str, triage: str, p: Patient):
     actions = []
-    if "🔴" in triage:
+    if triage.startswith("🔴"):
         actions += ["ABC + monitor + đường truyền", "Bác sĩ đánh giá ngay", "Đo lại sinh hiệu liên tục"]
-    elif "🟡" in triage:
+    elif triage.startswith("🟡"):
         actions += ["Khám ưu tiên", "Theo dõi sát", "Cận lâm sàng theo triệu chứng"]
     else:
         actions += ["Theo dõi cơ bản", "Tư vấn và dặn tái khám"]
 
-    if "Tim mạch" in dept: actions += ["ECG sớm", "Men tim theo protocol"]
-    if "Thần kinh" in dept: actions += ["Đường huyết", "CT theo quy trình đột quỵ"]
-    if "Hô hấp" in dept: actions += ["Oxy", "X-quang phổi/khí máu nếu cần"]
-    if "Ngoại" in dept: actions += ["ABCDE", "Kiểm soát chảy máu/bất động"]
-    if "Sản" in dept: actions += ["Đánh giá mẹ và thai"]
+    for key, extra in DEPT_ACTIONS:
+        if key in dept: actions += extra
     if p.anaphylaxis: actions += ["Phác đồ phản vệ"]
     if p.fast_stroke: actions += ["Kích hoạt stroke pathway"]
-    # dedup
-    out, seen = [], set()
-    for a in actions:
-        if a not in seen:
-            seen.add(a); out.append(a)
-    return out
+    return list(dict.fromkeys(actions))  # dedup, keeping first-seen order
 
 
 # =========================
 # TREND
 # =========================
+# (column, +1 if a rise is worse / -1 if a fall is worse, message)
+TREND_RULES = (
+    ("EWS", 1, "EWS tăng"),
+    ("SpO2", -1, "SpO₂ giảm"),
+    ("SBP", -1, "SBP giảm"),
+    ("GCS", -1, "GCS giảm"),
+)
+TREND_RULE_COLS = [c for c, _, _ in TREND_RULES]
+TREND_RULE_SIGNS = np.array([s for _, s, _ in TREND_RULES])
+
+
 def detect_worsening_trend(df: pd.DataFrame):
     if len(df) < 3:
         return None
-    last3 = df.tail(3)
-    reasons = []
-    if last3["EWS"].iloc[-1] > last3["EWS"].iloc[0]: reasons.append("EWS tăng")
-    if last3["SpO2"].iloc[-1] < last3["SpO2"].iloc[0]: reasons.append("SpO₂ giảm")
-    if last3["SBP"].iloc[-1] < last3["SBP"].iloc[0]: reasons.append("SBP giảm")
-    if last3["GCS"].iloc[-1] < last3["GCS"].iloc[0]: reasons.append("GCS giảm")
+    last3 = df[TREND_RULE_COLS].tail(3).to_numpy()
+    worse = (last3[-1] - last3[0]) * TREND_RULE_SIGNS > 0
+    reasons = [TREND_RULES[i][2] for i in np.flatnonzero(worse)]
     return ("Xu hướng xấu: " + ", ".join(reasons)) if reasons else None
 
 
+# =========================
+# CASE PIPELINE
+# =========================
+@st.cache_data(show_spinner=False, max_entries=1024)
+def evaluate_case(p: Patient) -> dict:
+    """
+    Full triage pipeline for one validated patient. Pure in `p` (frozen, hashed by
+    field values), so re-submitting the same intake skips all scoring.
+    """
+    g = gcs_total(p)
+    si = calculate_shock_index(p.hr, p.sbp)
+    ews = calculate_ews(p.hr, p.rr, p.sbp, p.temp, p.spo2)
+    flags = red_flags(p, si, ews)
+
+    esi, esi_note = esi_level(p, flags, ews)
+    risk, u, contrib = ensemble_predict_with_explain(p)
+    triage, color, note = triage_decision(flags, ews, risk, u, p)
+    dept, dept_reason = recommend_department(p, triage, flags)
+    return {
+        "g": g, "si": si, "ews": ews, "flags": flags,
+        "esi": esi, "esi_note": esi_note,
+        "risk": risk, "u": u, "unc_level": uncertainty_level(u), "contrib": contrib,
+        "triage": triage, "color": color, "note": note,
+        "dept": dept, "dept_reason": dept_reason,
+        "actions": protocol_actions(dept, triage, p),
+        "alert": should_alert(flags, ews),
+        "blue": is_code_blue(p),
+    }
+
+
 # =========================
 # PDF EXPORT
 # =========================
-def make_pdf_bytes(title: str, lines: list[str]) -> bytes:
+@st.cache_data(show_spinner=False, max_entries=32)
+def make_pdf_bytes(title: str, lines: tuple[str, ...]) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
@@ -457,14 +620,19 @@ def make_pdf_bytes(title: str, lines: list[str]) -> bytes:
     c.drawString(50, y, title)
     y -= 26
 
-    c.setFont("Helvetica", 10)
+    # One text object (a single BT/ET block) per page instead of a drawString per line.
+    text = c.beginText(50, y)
+    text.setFont("Helvetica", 10)
+    text.setLeading(14)
     for line in lines:
-        if y < 60:
+        if text.getY() < 60:
+            c.drawText(text)
             c.showPage()
-            c.setFont("Helvetica", 10)
-            y = height - 60
-        c.drawString(50, y, line[:120])
-        y -= 14
+            text = c.beginText(50, height - 60)
+            text.setFont("Helvetica", 10)
+            text.setLeading(14)
+        text.textLine(line[:120])
+    c.drawText(text)
 
     c.showPage()
     c.save()
@@ -475,19 +643,22 @@ def make_pdf_bytes(title: str, lines: list[str]) -> bytes:
 # =========================
 # QR SYNC
 # =========================
+PAYLOAD_KEYS = (
+    "Thời gian","Tuổi","HR","SBP","SpO2","RR","Temp","GCS","E","V","M",
+    "Đau ngực","Khó thở","Chấn thương","VAS","Khởi phát","Diễn tiến",
+    "FAST","Chảy máu","Đau bụng","Thai kỳ","Nghi nhiễm","Phản vệ","Ngộ độc",
+    "EWS","ShockIndex","ESI","Risk","Uncertainty","UncLevel","RedFlags",
+    "ALERT","Phân loại","Khoa đề xuất","Lý do chuyển khoa","Ghi chú","SBAR","AppVersion",
+)
+
+
 def make_case_payload(case_row: dict) -> str:
     """
     Encode a minimal JSON payload for QR/transfer.
     Keep it small & stable (no huge arrays).
     """
-    minimal = {k: case_row.get(k) for k in [
-        "Thời gian","Tuổi","HR","SBP","SpO2","RR","Temp","GCS","E","V","M",
-        "Đau ngực","Khó thở","Chấn thương","VAS","Khởi phát","Diễn tiến",
-        "FAST","Chảy máu","Đau bụng","Thai kỳ","Nghi nhiễm","Phản vệ","Ngộ độc",
-        "EWS","ShockIndex","ESI","Risk","Uncertainty","UncLevel","RedFlags",
-        "ALERT","Phân loại","Khoa đề xuất","Lý do chuyển khoa","Ghi chú","SBAR","AppVersion"
-    ]}
-    js = json.dumps(minimal, ensure_ascii=False)
+    minimal = dict(zip(PAYLOAD_KEYS, map(case_row.get, PAYLOAD_KEYS)))
+    js = json.dumps(minimal, ensure_ascii=False, separators=(",", ":"))  # compact → smaller QR
     b64 = base64.urlsafe_b64encode(js.encode("utf-8")).decode("utf-8")
     return b64
 
@@ -497,23 +668,105 @@ def payload_to_case(b64: str) -> dict:
     return json.loads(js)
 
 
-def make_qr_image(data: str) -> Image.Image:
+@st.cache_data(show_spinner=False, max_entries=64)
+def make_qr_png(data: str) -> bytes:
+    """QR code for `data` as PNG bytes (what st.image and the download both take)."""
+    import qrcode
+
     qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8, border=2)
     qr.add_data(data)
     qr.make(fit=True)
     img = qr.make_image(fill_color="black", back_color="white")
-    return img
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
 
 
 # =========================
 # STATE
 # =========================
+# Trend store is column-wise (one sequence per measure), so charts and trend checks
+# read columns directly instead of re-collecting them from per-row dicts.
+# Each column is a bounded deque: a long shift keeps only the latest window.
+TREND_COLUMNS = ("time", "HR", "SBP", "SpO2", "RR", "Temp", "GCS", "EWS", "ESI", "Risk")
+TREND_MAXLEN = 500
+LOG_PAGE = 50  # logs table shows the latest N cases, N grows by LOG_PAGE on demand
+
+
 def init_state():
-    if "logs" not in st.session_state: st.session_state["logs"] = []
+    if "logs" not in st.session_state: st.session_state["logs"] = {}
     if "last_case" not in st.session_state: st.session_state["last_case"] = None
-    if "vitals_series" not in st.session_state: st.session_state["vitals_series"] = []
+    if "vitals_series" not in st.session_state: st.session_state["vitals_series"] = {k: deque(maxlen=TREND_MAXLEN) for k in TREND_COLUMNS}
     if "enable_notify" not in st.session_state: st.session_state["enable_notify"] = False
     if "code_blue_events" not in st.session_state: st.session_state["code_blue_events"] = []
+    if "log_rows_shown" not in st.session_state: st.session_state["log_rows_shown"] = LOG_PAGE
+
+
+# Logs are column-wise too: {column: [value per case]}.
+def log_count() -> int:
+    return len(next(iter(st.session_state["logs"].values()), ()))
+
+
+def append_log(row: dict):
+    """Append one case; columns first seen in `row` (e.g. an imported payload) are back-filled with None."""
+    logs, n = st.session_state["logs"], log_count()
+    for k in row:
+        if k not in logs:
+            logs[k] = [None] * n
+    for k, col in logs.items():
+        col.append(row.get(k))
+
+
+def logs_csv_bytes() -> bytes:
+    """CSV of the logs streamed from the columns as UTF-8, without going through a DataFrame."""
+    logs = st.session_state["logs"]
+    buf = BytesIO()
+    text = TextIOWrapper(buf, encoding="utf-8", newline="")
+    writer = csv.writer(text, lineterminator="\n")
+    writer.writerow(logs.keys())
+    writer.writerows(zip(*logs.values()))
+    text.flush()
+    text.detach()  # keep buf open
+    return buf.getvalue()
+
+
+def logs_frame():
+    """Logs as (DataFrame, CSV bytes); rebuilt only when the number of logged cases changes."""
+    import pandas as pd
+
+    n = log_count()
+    if st.session_state.get("_logs_len") != n:
+        st.session_state["_logs_df"] = pd.DataFrame(st.session_state["logs"])
+        st.session_state["_logs_csv"] = logs_csv_bytes()
+        st.session_state["_logs_len"] = n
+    return st.session_state["_logs_df"], st.session_state["_logs_csv"]
+
+
+def logs_recompute_frame():
+    """Stored vs re-scored EWS / red flags / risk for every log; like logs_frame(), rebuilt only on new cases."""
+    n = log_count()
+    if st.session_state.get("_logs_re_len") != n:
+        df, _ = logs_frame()
+        df_re = df[["Thời gian", "EWS", "RedFlags", "Risk", "Uncertainty"]].copy()
+        df_re["EWS (tính lại)"] = calculate_ews(df["HR"], df["RR"], df["SBP"], df["Temp"], df["SpO2"])
+        df_re["RedFlags (tính lại)"] = [", ".join(f) for f in red_flags_batch(df)]
+        df_re["Risk (tính lại)"], df_re["Uncertainty (tính lại)"] = ensemble_predict_batch(features_batch(df))
+        st.session_state["_logs_re"] = df_re
+        st.session_state["_logs_re_len"] = n
+    return st.session_state["_logs_re"]
+
+
+def trend_frame() -> pd.DataFrame:
+    """Trend points indexed by time; appended at submit time, so already chronological: no sort needed."""
+    import pandas as pd
+
+    return pd.DataFrame(st.session_state["vitals_series"]).set_index("time")
+
+
+def code_blue_frame() -> pd.DataFrame:
+    import pandas as pd
+
+    return pd.DataFrame(st.session_state["code_blue_events"])
 
 
 init_state()
@@ -550,19 +803,24 @@ tab1, tab2, tab3, tab4 = st.tabs([
 # =========================
 # TAB 1: INTAKE
 # =========================
+GCS_E_OPTIONS = (4, 3, 2, 1)
+GCS_V_OPTIONS = (5, 4, 3, 2, 1)
+GCS_M_OPTIONS = (6, 5, 4, 3, 2, 1)
+ONSET_OPTIONS = ("Đột ngột", "Từ từ")
+PROGRESSION_OPTIONS = ("Nặng dần", "Ổn định", "Giảm")
+VAS_OPTIONS = tuple(range(11))
+
+
+def fmt_points(x: int) -> str:
+    return f"{x} điểm"
+
+
 with tab1:
     # CODE BLUE manual button (always visible)
     st.markdown("### 🚨 CODE BLUE")
     col_cb1, col_cb2 = st.columns([2, 3])
     with col_cb1:
-        code_blue_manual = st.button("KÍCH HOẠT CODE BLUE (TOÀN VIỆN)", type="primary")
-        # style class hack
-        st.markdown("""
-        <script>
-        const btns = window.parent.document.querySelectorAll('button[kind="primary"]');
-        btns.forEach(b => { if (b.innerText.includes("CODE BLUE")) b.classList.add("codeblue"); });
-        </script>
-        """, unsafe_allow_html=True)
+        code_blue_manual = st.button("KÍCH HOẠT CODE BLUE (TOÀN VIỆN)", type="primary", key="codeblue")
     with col_cb2:
         st.caption("Dùng khi sinh hiệu tụt cực nặng / ngưng tuần hoàn nghi ngờ. (Demo: chỉ log + cảnh báo UI)")
 
@@ -586,19 +844,19 @@ with tab1:
 
         with col2:
             st.subheader("🧠 Thần kinh (GCS)")
-            e = st.selectbox("Mở mắt (E)", [4, 3, 2, 1], format_func=lambda x: f"{x} điểm")
-            v = st.selectbox("Lời nói (V)", [5, 4, 3, 2, 1], format_func=lambda x: f"{x} điểm")
-            m = st.selectbox("Vận động (M)", [6, 5, 4, 3, 2, 1], format_func=lambda x: f"{x} điểm")
+            e = st.selectbox("Mở mắt (E)", GCS_E_OPTIONS, format_func=fmt_points)
+            v = st.selectbox("Lời nói (V)", GCS_V_OPTIONS, format_func=fmt_points)
+            m = st.selectbox("Vận động (M)", GCS_M_OPTIONS, format_func=fmt_points)
 
-            onset = st.selectbox("Khởi phát", ["Đột ngột", "Từ từ"])
-            progression = st.selectbox("Diễn tiến", ["Nặng dần", "Ổn định", "Giảm"])
+            onset = st.selectbox("Khởi phát", ONSET_OPTIONS)
+            progression = st.selectbox("Diễn tiến", PROGRESSION_OPTIONS)
 
         with col3:
             st.subheader("🔍 Triệu chứng + Context")
             chest_pain = st.checkbox("Đau ngực cấp")
             dyspnea = st.checkbox("Khó thở")
             trauma = st.checkbox("Chấn thương")
-            pain_level = st.select_slider("Mức độ đau (VAS)", options=list(range(11)), value=0)
+            pain_level = st.select_slider("Mức độ đau (VAS)", options=VAS_OPTIONS, value=0)
 
             fast_stroke = st.checkbox("FAST (+) nghi đột quỵ")
             bleeding = st.checkbox("Chảy máu")
@@ -627,19 +885,14 @@ with tab1:
         if not ok:
             st.stop()
 
-        g = gcs_total(p)
-        si = calculate_shock_index(p.hr, p.sbp)
-        ews = calculate_ews(p.hr, p.rr, p.sbp, p.temp, p.spo2)
-        flags = red_flags(p, si, ews)
-
-        esi, esi_note = esi_level(p, flags, ews)
-        risk, u, contrib_sorted, preds = ensemble_predict_with_explain(p)
-        triage, color, note = triage_decision(flags, ews, risk, u, p)
-        dept, dept_reason = recommend_department(p, triage, flags)
-        actions = protocol_actions(dept, triage, p)
-
-        alert = should_alert(flags, ews)
-        blue = is_code_blue(p)
+        now = datetime.now()  # one timestamp for every record this submit writes
+        c = evaluate_case(p)
+        g, si, ews, flags = c["g"], c["si"], c["ews"], c["flags"]
+        esi, esi_note = c["esi"], c["esi_note"]
+        risk, u, contrib = c["risk"], c["u"], c["contrib"]
+        triage, color, note = c["triage"], c["color"], c["note"]
+        dept, dept_reason, actions = c["dept"], c["dept_reason"], c["actions"]
+        alert, blue = c["alert"], c["blue"]
 
         st.markdown(f"<div class='triage-header' style='background-color:{color};'><h2>{triage}</h2></div>", unsafe_allow_html=True)
         st.caption(note)
@@ -658,7 +911,7 @@ with tab1:
 
         if blue:
             st.error("🛑 NGƯỠNG CODE BLUE (AUTO): Sinh hiệu cực nguy kịch! (Demo: bật cảnh báo + ghi log)")
-            st.session_state["code_blue_events"].append({"time": datetime.now().isoformat(), "type": "AUTO", "SBP": p.sbp, "SpO2": p.spo2, "GCS": g})
+            st.session_state["code_blue_events"].append({"time": now.isoformat(), "type": "AUTO", "SBP": p.sbp, "SpO2": p.spo2, "GCS": g})
             if st.session_state["enable_notify"]:
                 send_alert(f"[CODE BLUE] SBP={p.sbp} SpO2={p.spo2} GCS={g} | Dept={dept}")
                 st.success("✅ Đã gửi CODE BLUE (demo).")
@@ -674,10 +927,8 @@ with tab1:
         st.caption(f"Lý do: {dept_reason}")
 
         st.markdown("### 🧾 Protocol / Hành động gợi ý")
-        st.markdown("<div class='box'>", unsafe_allow_html=True)
-        for a in actions[:12]:
-            st.write("• " + a)
-        st.markdown("</div>", unsafe_allow_html=True)
+        # One element, so the bullets actually render inside the .box frame.
+        st.markdown("<div class='box'>" + "<br>".join("• " + a for a in actions[:12]) + "</div>", unsafe_allow_html=True)
 
         sbar = (
             f"SBAR: BN {p.age}t. GCS {g}/15. HR {p.hr}. SBP {p.sbp}. RR {p.rr}. "
@@ -688,15 +939,13 @@ with tab1:
         st.text_area("Tóm tắt (SBAR):", sbar)
 
         # trend store
-        st.session_state["vitals_series"].append({
-            "time": datetime.now(),
-            "HR": p.hr, "SBP": p.sbp, "SpO2": p.spo2, "RR": p.rr, "Temp": p.temp,
-            "GCS": g, "EWS": ews, "ESI": esi
-        })
+        series = st.session_state["vitals_series"]
+        for k, val in zip(TREND_COLUMNS, (now, p.hr, p.sbp, p.spo2, p.rr, p.temp, g, ews, esi, risk)):
+            series[k].append(val)
 
         # logs
         row = {
-            "Thời gian": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "Thời gian": now.isoformat(sep=" ", timespec="seconds"),  # YYYY-MM-DD HH:MM:SS
             "Tuổi": p.age, "HR": p.hr, "SBP": p.sbp, "SpO2": p.spo2, "RR": p.rr, "Temp": p.temp,
             "GCS": g, "E": p.gcs_e, "V": p.gcs_v, "M": p.gcs_m,
             "Đau ngực": p.chest_pain, "Khó thở": p.dyspnea, "Chấn thương": p.trauma, "VAS": p.pain_level,
@@ -706,7 +955,7 @@ with tab1:
             "Phản vệ": p.anaphylaxis, "Ngộ độc": p.poisoning_overdose,
             "EWS": ews, "ShockIndex": si,
             "ESI": esi,
-            "Risk": risk, "Uncertainty": u, "UncLevel": uncertainty_level(u),
+            "Risk": risk, "Uncertainty": u, "UncLevel": c["unc_level"],
             "RedFlags": ", ".join(flags),
             "ALERT": alert,
             "CODE_BLUE_AUTO": blue,
@@ -718,8 +967,8 @@ with tab1:
             "AppVersion": APP_VERSION
         }
 
-        st.session_state["logs"].append(row)
-        st.session_state["last_case"] = {"row": row, "contrib_sorted": contrib_sorted}
+        append_log(row)
+        st.session_state["last_case"] = {"row": row, "contrib": contrib}
 
         st.markdown("<div class='small-note'>⚠️ Demo học thuật. Quyết định cuối cùng thuộc bác sĩ.</div>", unsafe_allow_html=True)
 
@@ -729,11 +978,13 @@ with tab1:
 # =========================
 with tab2:
     st.subheader("📈 Xu hướng sinh hiệu theo thời gian (Trend)")
-    if st.session_state["vitals_series"]:
-        tdf = pd.DataFrame(st.session_state["vitals_series"]).sort_values("time").reset_index(drop=True)
+    if st.session_state["vitals_series"]["time"]:
+        tdf = trend_frame()
 
-        st.line_chart(tdf.set_index("time")[["HR", "SBP", "SpO2", "RR", "Temp"]])
-        st.line_chart(tdf.set_index("time")[["GCS", "EWS"]])
+        st.line_chart(tdf[["HR", "SBP", "SpO2", "RR", "Temp"]])
+        st.line_chart(tdf[["GCS", "EWS"]])
+        # Risk is stored when each point is scored, so charting it costs nothing extra.
+        st.line_chart(tdf[["Risk"]])
 
         msg = detect_worsening_trend(tdf)
         if msg:
@@ -755,10 +1006,10 @@ with tab3:
         st.info("Chưa có ca. Vào tab Tiếp nhận → PHÂN LOẠI NGAY.")
     else:
         row = case["row"]
-        contrib_sorted = case["contrib_sorted"]
+        contrib = case["contrib"]
 
         st.markdown("### 1) Feature Importance (dạng % để trả lời BGK “vì sao ra 1.8%?”)")
-        df_imp = feature_importance_percent(contrib_sorted, top_n=10)
+        df_imp = feature_importance_percent(contrib, top_n=10)
         st.dataframe(df_imp, use_container_width=True, height=360)
         st.bar_chart(df_imp.set_index("Yếu tố")[["Đóng góp (%)"]])
 
@@ -785,7 +1036,7 @@ with tab3:
         for _, r in df_imp.head(8).iterrows():
             lines.append(f"{r['Yếu tố']}: {r['Đóng góp (%)']:.1f}% ({r['Hướng']})")
 
-        pdf_bytes = make_pdf_bytes("SMART TRIAGE AI – PDF SUMMARY", lines)
+        pdf_bytes = make_pdf_bytes("SMART TRIAGE AI – PDF SUMMARY", tuple(lines))
         st.download_button(
             "⬇️ Tải PDF",
             data=pdf_bytes,
@@ -801,12 +1052,9 @@ with tab3:
         st.caption("Cách dùng: máy khác mở app → tab “Nhập ca từ QR/Payload” → dán payload (hoặc quét QR nếu bạn tích hợp camera sau).")
         st.code(payload[:220] + ("..." if len(payload) > 220 else ""))
 
-        qr_img = make_qr_image(payload)
-        st.image(qr_img, caption="QR đồng bộ ca bệnh (payload base64)", width=260)
-
-        buf = BytesIO()
-        qr_img.save(buf, format="PNG")
-        st.download_button("⬇️ Tải QR (PNG)", data=buf.getvalue(), file_name="case_qr.png", mime="image/png", use_container_width=True)
+        qr_png = make_qr_png(payload)
+        st.image(qr_png, caption="QR đồng bộ ca bệnh (payload base64)", width=260)
+        st.download_button("⬇️ Tải QR (PNG)", data=qr_png, file_name="case_qr.png", mime="image/png", use_container_width=True)
 
 
 # =========================
@@ -820,8 +1068,10 @@ with tab4:
     if st.button("📥 LOAD CASE", use_container_width=True):
         try:
             obj = payload_to_case(payload_in.strip())
+            if not isinstance(obj, dict):
+                raise ValueError("payload phải là một JSON object")
             # Add to logs
-            st.session_state["logs"].append(obj)
+            append_log(obj)
             st.success("✅ Đã import ca vào logs.")
             st.json(obj)
         except Exception as e:
@@ -829,17 +1079,29 @@ with tab4:
 
     st.markdown("---")
     st.subheader("📑 Logs/Export CSV + CodeBlue events")
-    if st.session_state["logs"]:
-        df = pd.DataFrame(st.session_state["logs"])
-        st.dataframe(df, use_container_width=True, height=380)
+    if log_count():
+        df, csv_bytes = logs_frame()
+        shown = st.session_state["log_rows_shown"]
+        st.dataframe(df.tail(shown), use_container_width=True, height=380)
+        if len(df) > shown:
+            st.caption(f"Đang hiển thị {shown}/{len(df)} ca gần nhất (CSV luôn đủ toàn bộ).")
+            if st.button(f"Xem thêm {LOG_PAGE} ca", use_container_width=True):
+                st.session_state["log_rows_shown"] += LOG_PAGE
+                st.rerun()
         st.download_button(
             "⬇️ Tải CSV",
-            data=df.to_csv(index=False).encode("utf-8"),
+            data=csv_bytes,
             file_name="triage_logs.csv",
             mime="text/csv",
             use_container_width=True,
         )
 
+        with st.expander("🔁 Tính lại red flags + Risk trên toàn bộ logs"):
+            try:
+                st.dataframe(logs_recompute_frame().tail(shown), use_container_width=True)
+            except Exception as e:
+                st.error(f"Không tính lại được: {e}")
+
     if st.session_state["code_blue_events"]:
         st.markdown("### 🚨 Code Blue events (audit)")
-        st.dataframe(pd.DataFrame(st.session_state["code_blue_events"]), use_container_width=True)
+        st.dataframe(code_blue_frame(), use_container_width=True)